@@ -5,17 +5,41 @@ mqtt2elasticsearch.py - a tool that subscribes to mqtt topics and writes the
 Author: Michael Oberdorf
 Date: 2019-03-14
 Last modified by: Michael Oberdorf
-Last changed at: 2024-12-23
+Last changed at: 2026-10-15
 *************************************************************************** """
+import atexit
 import json
 import logging
 import os
+import queue
+import re
+import signal
 import ssl
 import sys
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 import paho.mqtt.client as mqtt
 from elasticsearch import Elasticsearch
+from paho.mqtt.subscribeoptions import SubscribeOptions
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:
+    OrjsonSerializer = None
 
 VERSION = "1.1.1"
 
@@ -31,6 +55,59 @@ if "ELASTICSEARCH_MAPPING_FILE" in os.environ:
 with open(ELASTICSEARCH_MAPPING_FILE) as f:
     topic2index = json.load(f)
 
+# MQTT topic to (index name, index body, index name contains placeholders)
+TOPIC_ROUTE = {
+    sys.intern(topic): (
+        value["elasticIndex"],
+        value["elasticBody"],
+        any(p in value["elasticIndex"] for p in ("{Y}", "{m}", "{d}")),
+    )
+    for topic, value in topic2index.items()
+}
+# subscriptions with wildcards, to route messages whose topic is not a key of TOPIC_ROUTE
+WILDCARD_ROUTES = tuple((topic, route) for topic, route in TOPIC_ROUTE.items() if "+" in topic or "#" in topic)
+# routes of topics matched against WILDCARD_ROUTES, None if no subscription matches
+WILDCARD_TOPIC_ROUTE = {}
+WILDCARD_TOPIC_ROUTE_SIZE = 10000
+
+# buffer of documents waiting to be sent to Elasticsearch via the bulk API
+BULK_BUFFER = deque()
+# payload bytes of the documents in BULK_BUFFER
+BULK_BUFFER_BYTES = 0
+# serializes the flushes, BULK_BUFFER_LOCK guards the changes of the buffer itself
+BULK_LOCK = threading.Lock()
+BULK_BUFFER_LOCK = threading.Lock()
+BULK_FLUSH_EVENT = threading.Event()
+# set together with BULK_FLUSH_EVENT to send the whole buffer, not only full chunks
+BULK_FLUSH_ALL_EVENT = threading.Event()
+# upper limit of the payload size of a single bulk request
+BULK_MAX_BYTES = 100 * 1024 * 1024
+# retries of documents rejected by Elasticsearch with status 429 (too many requests)
+BULK_MAX_RETRIES = 3
+
+# index names split into literal fragments and placeholder tokens (Y, m, d),
+# e.g. "mydata-{Y}-{m}" -> ["mydata-", "Y", "-", "m", ""]
+INDEX_PLACEHOLDER_PATTERN = re.compile(r"\{([Ymd])\}")
+INDEX_TEMPLATES = {
+    value["elasticIndex"]: INDEX_PLACEHOLDER_PATTERN.split(value["elasticIndex"]) for value in topic2index.values()
+}
+
+# resolved index names, keyed by (index name with placeholders, day)
+INDEX_NAME_CACHE = {}
+INDEX_NAME_CACHE_DATE = None
+
+# Elasticsearch indices that are known to exist, to skip the check per message
+KNOWN_INDICES = set()
+INDEX_LOCK = threading.Lock()
+
+# received MQTT messages waiting to be processed by the worker threads
+MESSAGE_QUEUE = queue.SimpleQueue()
+STOP_EVENT = threading.Event()
+EXIT_CODE = 0
+
+# reusable simdjson parser per worker thread, for payload validation
+JSON_PARSER = threading.local()
+
 
 """
 ###############################################################################
@@ -46,38 +123,58 @@ def prepareElasticsearchIndex(index: str) -> str:
     @param: index, str(): The Elasticsearch index name with placeholders
     @return: str(): The resolved Elasticsearch index name
     """
+    global INDEX_NAME_CACHE_DATE
 
-    elasticIndex = (
-        index.replace("{Y}", datetime.today().strftime("%Y"))
-        .replace("{m}", datetime.today().strftime("%m"))
-        .replace("{d}", datetime.today().strftime("%d"))
-    )
+    today = date.today()
+    elasticIndex = INDEX_NAME_CACHE.get((index, today))
+    if elasticIndex is not None:
+        return elasticIndex
+
+    # on a new day, forget the index names and indices of the previous days
+    with INDEX_LOCK:
+        if INDEX_NAME_CACHE_DATE is None or today > INDEX_NAME_CACHE_DATE:
+            INDEX_NAME_CACHE.clear()
+            KNOWN_INDICES.clear()
+            INDEX_NAME_CACHE_DATE = today
+
+    template = INDEX_TEMPLATES.get(index)
+    if template is None:
+        template = INDEX_TEMPLATES[index] = INDEX_PLACEHOLDER_PATTERN.split(index)
+
+    # every odd fragment is a placeholder token
+    tokens = {"Y": f"{today.year:04d}", "m": f"{today.month:02d}", "d": f"{today.day:02d}"}
+    elasticIndex = "".join(tokens[fragment] if i % 2 else fragment for i, fragment in enumerate(template))
+    INDEX_NAME_CACHE[(index, today)] = elasticIndex
 
     if index != elasticIndex:
         log.debug("Replacing placeholders in Elasticsearch index name:")
-        log.debug("  OLD: {}".format(index))
-        log.debug("  NEW: {}".format(elasticIndex))
+        log.debug("  OLD: %s", index)
+        log.debug("  NEW: %s", elasticIndex)
 
     return elasticIndex
 
 
-def createElasticsearchIndex(index: str, body: dict):
+def createElasticsearchIndex(index: str, body: dict, skipPrepare: bool = False, checkExists: bool = True):
     """
     createElasticsearchIndex
     @desc: creates a new index in Elasticsearch DB if not exist
     @param index, str(): Elasticsearch index name
     @param body, dict(): Elasticsearch index settings and mappings
+    @param skipPrepare, bool(): The index name is already resolved (default: False)
+    @param checkExists, bool(): Check if the index exists before creating it (default: True)
     @return: None
     """
 
-    index = prepareElasticsearchIndex(index)
+    if not skipPrepare:
+        index = prepareElasticsearchIndex(index)
 
-    if not es.indices.exists(index=index):
-        log.debug("Creating elasticsearch index: {}{}".format(CONFIG["elasticsearch"]["cluster"][0], index))
-        log.debug("  {}".format(body))
-        es.indices.create(index=index, body=body)
-    else:
+    if checkExists and es.indices.exists(index=index):
         log.debug("Skip creation of elasticsearch Index, because it already exists.")
+    else:
+        log.debug("Creating elasticsearch index: %s%s", ES_HOST, index)
+        log.debug("  %s", body)
+        es.indices.create(index=index, body=body)
+    KNOWN_INDICES.add(index)
 
     return None
 
@@ -94,8 +191,9 @@ def removeElasticsearchIndex(index: str, exitAfterRemoval: bool = True):
     index = prepareElasticsearchIndex(index)
 
     if es.indices.exists(index=index):
-        log.debug("Removing elasticsearch Index: {}".format(index))
+        log.debug("Removing elasticsearch Index: %s", index)
         es.indices.delete(index=index)
+        KNOWN_INDICES.discard(index)
     else:
         log.debug("Skip to removing elasticsearch Index, because it is not existing.")
 
@@ -106,7 +204,186 @@ def removeElasticsearchIndex(index: str, exitAfterRemoval: bool = True):
         return None
 
 
-def on_connect(client, userdata, flags, rc):
+def requeueBulkActions(actions: list):
+    """
+    requeueBulkActions
+    @desc: puts documents that could not be sent back to the front of the bulk
+      buffer, the oldest ones are dropped if the buffer would exceed its limits
+    @param actions, list(): The bulk actions to send again
+    @return: None
+    """
+    global BULK_BUFFER_BYTES
+
+    with BULK_BUFFER_LOCK:
+        # keep the newest documents that still fit into the buffer
+        space = max(BULK_BUFFER_SIZE - len(BULK_BUFFER), 0)
+        spaceBytes = BULK_BUFFER_MAX_BYTES - BULK_BUFFER_BYTES
+        keep = 0
+        for action in reversed(actions):
+            if keep >= space or len(action["_source"]) > spaceBytes:
+                break
+            spaceBytes -= len(action["_source"])
+            keep += 1
+        if keep < len(actions):
+            log.warning("Bulk buffer is full, dropping %s documents", len(actions) - keep)
+            actions = actions[len(actions) - keep :]
+        BULK_BUFFER.extendleft(reversed(actions))
+        BULK_BUFFER_BYTES = BULK_BUFFER_MAX_BYTES - spaceBytes
+
+    return None
+
+
+def sendBulkChunk(actions: list):
+    """
+    sendBulkChunk
+    @desc: sends documents to Elasticsearch with a single bulk request, so that
+      the response tells exactly which documents were added. Documents rejected
+      with status 429 are retried.
+    @param actions, list(): The bulk actions to send
+    @return: tuple(): The number of added documents and the list of actions
+      that could not be sent and have to be sent again
+    """
+
+    success = 0
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        if attempt:
+            # same backoff as the bulk helpers of the Elasticsearch client
+            time.sleep(2**attempt)
+
+        operations = []
+        for action in actions:
+            operations.append({"index": {"_index": action["_index"]}})
+            operations.append(action["_source"])
+
+        try:
+            response = es.bulk(operations=operations)
+        except Exception as e:
+            log.error("Failed to send %s documents to Elasticsearch, will retry: %s", len(actions), e)
+            return success, actions
+
+        if not response["errors"]:
+            return success + len(actions), []
+
+        # the response items are in the same order as the actions
+        rejected = []
+        for action, item in zip(actions, response["items"]):
+            result = item["index"]
+            if result["status"] < 300:
+                success += 1
+            elif result["status"] == 429:
+                rejected.append(action)
+            else:
+                log.error("Failed to add document to Elasticsearch: %s", result)
+                if result.get("error", {}).get("type") == "index_not_found_exception":
+                    # the index was deleted, check and create it again for the next message
+                    KNOWN_INDICES.discard(action["_index"])
+
+        if not rejected:
+            return success, []
+        actions = rejected
+
+    log.error("Elasticsearch rejected %s documents with too many requests, will retry", len(actions))
+    return success, actions
+
+
+def flushBulkBuffer(fullChunksOnly: bool = False) -> bool:
+    """
+    flushBulkBuffer
+    @desc: sends the buffered documents to Elasticsearch via the bulk API
+    @param fullChunksOnly, bool(): Only send chunks of bulk_size documents and
+      keep the remainder for the next flush (default: False)
+    @return: bool(): False if documents could not be sent and were put back
+    """
+    global BULK_BUFFER_BYTES
+
+    with BULK_LOCK:
+        with BULK_BUFFER_LOCK:
+            count = len(BULK_BUFFER)
+            if fullChunksOnly:
+                count -= count % BULK_SIZE
+            if not count:
+                return True
+            actions = [BULK_BUFFER.popleft() for _ in range(count)]
+            BULK_BUFFER_BYTES -= sum(len(action["_source"]) for action in actions)
+
+        log.debug("Sending %s documents to Elasticsearch via bulk API", len(actions))
+        # a chunk is limited by bulk_size and by BULK_MAX_BYTES
+        chunks = [[]]
+        chunkBytes = 0
+        for action in actions:
+            actionBytes = len(action["_source"])
+            if len(chunks[-1]) >= BULK_SIZE or (chunks[-1] and chunkBytes + actionBytes > BULK_MAX_BYTES):
+                chunks.append([])
+                chunkBytes = 0
+            chunks[-1].append(action)
+            chunkBytes += actionBytes
+        results = None
+        if len(actions) >= 2 * BULK_SIZE and BULK_EXECUTOR is not None:
+            # a backlog of several chunks is sent with concurrent bulk requests
+            try:
+                results = list(BULK_EXECUTOR.map(sendBulkChunk, chunks))
+            except RuntimeError:
+                # the executor does not accept new work during interpreter shutdown
+                pass
+        if results is None:
+            results = [sendBulkChunk(chunk) for chunk in chunks]
+
+        # put the failed documents back once and in their original order
+        failed = [action for _, failedActions in results for action in failedActions]
+        if failed:
+            requeueBulkActions(failed)
+
+    success = sum(result for result, _ in results)
+    if success:
+        log.info("Added %s documents to Elasticsearch", success)
+
+    return not failed
+
+
+def bulkFlushWorker():
+    """
+    bulkFlushWorker
+    @desc: background thread that flushes the bulk buffer when it is full or
+      when the flush interval has elapsed
+    @return: None
+    """
+
+    while True:
+        # when woken up because the buffer is full, only whole chunks are sent
+        triggered = BULK_FLUSH_EVENT.wait(BULK_INTERVAL)
+        BULK_FLUSH_EVENT.clear()
+        flushAll = BULK_FLUSH_ALL_EVENT.is_set()
+        BULK_FLUSH_ALL_EVENT.clear()
+        if not flushBulkBuffer(fullChunksOnly=triggered and not flushAll):
+            # give Elasticsearch some time to recover before sending again
+            time.sleep(BULK_INTERVAL)
+
+
+def validatePayload(payload: bytes) -> bool:
+    """
+    validatePayload
+    @desc: checks if the MQTT payload is valid JSON, with a reusable simdjson
+      parser if available, otherwise with orjson or the json module
+    @param payload, bytes(): The MQTT message payload
+    @return: bool(): True if the payload is valid JSON
+    """
+
+    try:
+        if simdjson is None:
+            json_loads(payload)
+        else:
+            if not hasattr(JSON_PARSER, "parser"):
+                JSON_PARSER.parser = simdjson.Parser()
+            # the parsed document is not kept, so the parser can be reused
+            JSON_PARSER.parser.parse(payload)
+    except ValueError as e:
+        log.debug("Invalid JSON payload: %s", e)
+        return False
+
+    return True
+
+
+def on_connect(client, userdata, flags, reason_code, properties):
     """
     on_connect
     @desc: Function call when (re-)connecting to the MQTT broker. We subscribe
@@ -114,25 +391,50 @@ def on_connect(client, userdata, flags, rc):
     @param client, paho.mqtt.client.Client(): The object of the MQTT connection
     @param userdata, any: user defined data of any type that is passed as the userdata
        parameter to callbacks. Defined within the Client() constructor.
-    @param flags, dict(): JsonString, connection parameters
-    @param rc, int(): the return code
+    @param flags, paho.mqtt.client.ConnectFlags(): The connection flags from the broker
+    @param reason_code, paho.mqtt.reasoncodes.ReasonCode(): The connection result
+    @param properties, paho.mqtt.properties.Properties(): The MQTTv5 properties from the broker
     @return: None
     """
+    global EXIT_CODE
 
     log.debug("After connecting to MQTT server:")
-    log.debug("- userdata: {}".format(userdata))
-    log.debug("- flags: {}".format(flags))
-    log.debug("- rc: {}".format(rc))
+    log.debug("- userdata: %s", userdata)
+    log.debug("- flags: %s", flags)
+    log.debug("- reason_code: %s", reason_code)
 
     # check for return code
-    if rc != 0:
-        log.error("Error in connecting to MQTT Server, RC={}".format(rc))
-        sys.exit(1)
+    if reason_code.is_failure:
+        log.error("Error in connecting to MQTT Server, RC=%s", reason_code)
+        EXIT_CODE = 1
+        STOP_EVENT.set()
+        return None
 
     # Subscribing in on_connect() means that if we lose the connection and reconnect then subscriptions will be renewed.
-    for topic in topic2index.keys():
-        log.debug("Subscribe to MQTT topic: {}".format(topic))
-        client.subscribe(topic)
+    if MQTT_SUBSCRIPTIONS:
+        log.debug("Subscribe to MQTT topics: %s", [topic for topic, _ in MQTT_SUBSCRIPTIONS])
+        client.subscribe(MQTT_SUBSCRIPTIONS)
+
+    return None
+
+
+def on_disconnect(client, userdata, flags, reason_code, properties):
+    """
+    on_disconnect
+    @desc: Function call when the client disconnects from the MQTT broker. We
+      let the flush thread send the documents that are still buffered.
+    @param client, paho.mqtt.client.Client(): The object of the MQTT connection
+    @param userdata, any: user defined data of any type that is passed as the userdata
+       parameter to callbacks. Defined within the Client() constructor.
+    @param flags, paho.mqtt.client.DisconnectFlags(): The disconnection flags
+    @param reason_code, paho.mqtt.reasoncodes.ReasonCode(): The disconnection reason
+    @param properties, paho.mqtt.properties.Properties(): The MQTTv5 properties from the broker
+    @return: None
+    """
+
+    log.debug("Disconnected from MQTT server, reason_code: %s", reason_code)
+    BULK_FLUSH_ALL_EVENT.set()
+    BULK_FLUSH_EVENT.set()
 
     return None
 
@@ -141,6 +443,7 @@ def on_message(client, userdata, msg):
     """
     on_message
     @desc: The MQTT callback for when a PUBLISH message is received from the server.
+      The message is handed over to the worker threads.
     @param client, paho.mqtt.client.Client(): The object of the MQTT connection
     @param userdata, any: user defined data of any type that is passed as the userdata
        parameter to callbacks. Defined within the Client() constructor.
@@ -148,22 +451,114 @@ def on_message(client, userdata, msg):
     @return: None
     """
 
+    if len(msg.payload) > MAX_PAYLOAD_BYTES:
+        log.warning("Skip oversized payload from MQTT topic %s (%s bytes)", msg.topic, len(msg.payload))
+        return None
+
+    MESSAGE_QUEUE.put((msg.topic, msg.payload))
+
+    return None
+
+
+def processMessage(topic: str, payload: bytes):
+    """
+    processMessage
+    @desc: prepares the Elasticsearch index for a received MQTT message and
+      queues the payload for the bulk API
+    @param topic, str(): The MQTT topic the message was received from
+    @param payload, bytes(): The MQTT message payload
+    @return: None
+    """
+    global BULK_BUFFER_BYTES
+
     log.debug("MQTT message received:")
-    log.debug("- userdata: {}".format(userdata))
+    log.debug("- topic: %s", topic)
+
+    # find the index configuration of the topic
+    route = TOPIC_ROUTE.get(topic)
+    if route is None:
+        try:
+            route = WILDCARD_TOPIC_ROUTE[topic]
+        except KeyError:
+            route = next((r for sub, r in WILDCARD_ROUTES if mqtt.topic_matches_sub(sub, topic)), None)
+            # start over instead of growing without limit on ever new topics
+            if len(WILDCARD_TOPIC_ROUTE) >= WILDCARD_TOPIC_ROUTE_SIZE:
+                WILDCARD_TOPIC_ROUTE.clear()
+            WILDCARD_TOPIC_ROUTE[topic] = route
+        if route is None:
+            log.warning("Skip message from MQTT topic %s, no index configured", topic)
+            return None
 
     # prepare index
-    index = prepareElasticsearchIndex(topic2index[msg.topic]["elasticIndex"])
+    index, body, hasPlaceholder = route
+    if hasPlaceholder:
+        index = prepareElasticsearchIndex(index)
 
     # check if index exist, if not trigger creation
-    if not es.indices.exists(index=index):
-        createElasticsearchIndex(index, topic2index[msg.topic]["elasticBody"])
+    if index not in KNOWN_INDICES:
+        with INDEX_LOCK:
+            if index not in KNOWN_INDICES:
+                if not es.indices.exists(index=index):
+                    createElasticsearchIndex(index, body, skipPrepare=True, checkExists=False)
+                KNOWN_INDICES.add(index)
+
+    # the payload is forwarded as it is, parse it only if validation is requested
+    if VALIDATE_PAYLOAD and not validatePayload(payload):
+        log.error("Skip invalid JSON payload from MQTT topic %s", topic)
+        return None
+
+    log.debug("- payload: %s", payload)
+
+    # the bulk API expects one document per line
+    log.debug("Queue data for elasticsearch index: %s", index)
+    action = {"_index": index, "_source": payload.replace(b"\n", b" ")}
+    with BULK_BUFFER_LOCK:
+        buffered = len(BULK_BUFFER)
+        if buffered < BULK_BUFFER_SIZE and BULK_BUFFER_BYTES + len(payload) <= BULK_BUFFER_MAX_BYTES:
+            BULK_BUFFER.append(action)
+            BULK_BUFFER_BYTES += len(payload)
+            buffered += 1
+        else:
+            action = None
+    if action is None:
+        log.warning("Skip message from MQTT topic %s, the bulk buffer is full", topic)
+        BULK_FLUSH_EVENT.set()
+        return None
+    if buffered >= BULK_SIZE:
+        BULK_FLUSH_EVENT.set()
+
+    return None
+
 
-    # parse message payload as JSON object
-    PAYLOAD = json.loads(str(msg.payload.decode("utf-8")))
+def messageWorker():
+    """
+    messageWorker
+    @desc: worker thread that processes the received MQTT messages until it
+      gets None from the message queue
+    @return: None
+    """
 
-    log.info("Add data to elasticsearch index: {}".format(index))
-    res = es.index(index=index, body=json.dumps(PAYLOAD))
-    log.debug("{}".format(res["result"]))
+    while True:
+        item = MESSAGE_QUEUE.get()
+        if item is None:
+            return None
+        try:
+            processMessage(*item)
+        except Exception as e:
+            log.error("Failed to process MQTT message from topic %s: %s", item[0], e)
+
+
+def stop(signum, frame):
+    """
+    stop
+    @desc: signal handler to stop the processing gracefully
+    @param signum, int(): The signal number
+    @param frame, frame(): The current stack frame
+    @return: None
+    """
+
+    log.debug("Received signal %s, stopping", signum)
+    STOP_EVENT.set()
 
     return None
 
@@ -177,64 +572,90 @@ def on_message(client, userdata, msg):
 # initialize logger
 log = logging.getLogger()
 log_handler = logging.StreamHandler(sys.stdout)
-if "DEBUG" not in CONFIG:
+if CONFIG.setdefault("DEBUG", False):
+    log.setLevel(logging.DEBUG)
+    log_handler.setLevel(logging.DEBUG)
+else:
     log.setLevel(logging.INFO)
     log_handler.setLevel(logging.INFO)
-else:
-    if CONFIG["DEBUG"]:
-        log.setLevel(logging.DEBUG)
-        log_handler.setLevel(logging.DEBUG)
-    else:
-        log.setLevel(logging.INFO)
-        log_handler.setLevel(logging.INFO)
 log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 log_handler.setFormatter(log_formatter)
 log.addHandler(log_handler)
 
-log.info("MQTT to Eleasticsearch processor v{} started".format(VERSION))
+log.info("MQTT to Eleasticsearch processor v%s started", VERSION)
 
 
 # set some defaults
-if "removeIndex" not in CONFIG:
-    CONFIG["removeIndex"] = False
+CONFIG.setdefault("removeIndex", False)
+CONFIG.setdefault("validate_payload", False)
+CONFIG.setdefault("workers", 4)
+CONFIG.setdefault("max_payload_bytes", 1048576)
 if "mqtt" not in CONFIG:
-    log.error("MQTT specific configuration is missing in {}".format(ELASTICSEARCH_MAPPING_FILE))
-if "tls" not in CONFIG["mqtt"]:
-    CONFIG["mqtt"]["tls"] = False
-if "client_id" not in CONFIG["mqtt"]:
-    CONFIG["mqtt"]["client_id"] = None
-if "hostname_validation" not in CONFIG["mqtt"]:
-    CONFIG["mqtt"]["hostname_validation"] = True
-if "protocol_version" not in CONFIG["mqtt"]:
-    CONFIG["mqtt"]["protocol_version"] = 3
+    log.error("MQTT specific configuration is missing in %s", CONFIG_FILE)
+    sys.exit(1)
+CONFIG["mqtt"].setdefault("tls", False)
+CONFIG["mqtt"].setdefault("client_id", None)
+CONFIG["mqtt"].setdefault("hostname_validation", True)
+CONFIG["mqtt"].setdefault("protocol_version", 3)
+CONFIG["elasticsearch"].setdefault("bulk_size", 500)
+CONFIG["elasticsearch"].setdefault("bulk_interval", 1.0)
+CONFIG["elasticsearch"].setdefault("bulk_threads", 4)
+CONFIG["elasticsearch"].setdefault("bulk_buffer_size", 50000)
+CONFIG["elasticsearch"].setdefault("bulk_buffer_bytes", 104857600)
+CONFIG["elasticsearch"].setdefault("connections_per_node", 32)
+CONFIG["elasticsearch"].setdefault("http_compress", True)
+CONFIG["elasticsearch"].setdefault("request_timeout", 30)
+
+# configuration values used while processing messages
+ES_HOST = CONFIG["elasticsearch"]["cluster"][0]
+VALIDATE_PAYLOAD = CONFIG["validate_payload"]
+MAX_PAYLOAD_BYTES = CONFIG["max_payload_bytes"]
+BULK_SIZE = CONFIG["elasticsearch"]["bulk_size"]
+BULK_INTERVAL = CONFIG["elasticsearch"]["bulk_interval"]
+BULK_THREADS = CONFIG["elasticsearch"]["bulk_threads"]
+BULK_BUFFER_SIZE = CONFIG["elasticsearch"]["bulk_buffer_size"]
+BULK_BUFFER_MAX_BYTES = CONFIG["elasticsearch"]["bulk_buffer_bytes"]
+BULK_EXECUTOR = ThreadPoolExecutor(max_workers=BULK_THREADS) if BULK_THREADS > 1 else None
 
 # ------------------------------------------------------------------------------
-es = Elasticsearch(CONFIG["elasticsearch"]["cluster"])
+es = Elasticsearch(
+    CONFIG["elasticsearch"]["cluster"],
+    connections_per_node=CONFIG["elasticsearch"]["connections_per_node"],
+    http_compress=CONFIG["elasticsearch"]["http_compress"],
+    request_timeout=CONFIG["elasticsearch"]["request_timeout"],
+    retry_on_timeout=True,
+    serializer=OrjsonSerializer() if OrjsonSerializer is not None else None,
+)
 
 log.debug("Configure MQTT client:")
-log.debug("- client_id={}".format(CONFIG["mqtt"]["client_id"]))
+log.debug("- client_id=%s", CONFIG["mqtt"]["client_id"])
 log.debug("- transport=tcp")
 if CONFIG["mqtt"]["protocol_version"] == 5:
     log.debug("- protocol=MQTTv5")
-    client = mqtt.Client(client_id=CONFIG["mqtt"]["client_id"], userdata=None, transport="tcp", protocol=mqtt.MQTTv5)
+    client = mqtt.Client(
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+        client_id=CONFIG["mqtt"]["client_id"],
+        userdata=None,
+        transport="tcp",
+        protocol=mqtt.MQTTv5,
+    )
+    # don't receive our own messages back
+    MQTT_SUBSCRIPTIONS = [(topic, SubscribeOptions(qos=0, noLocal=True)) for topic in topic2index.keys()]
 else:
     log.debug("- clean_session=True")
-    log.debug("- protocol=MQTTv5")
+    log.debug("- protocol=MQTTv311")
     client = mqtt.Client(
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
         client_id=CONFIG["mqtt"]["client_id"],
         clean_session=True,
         userdata=None,
         transport="tcp",
         protocol=mqtt.MQTTv311,
     )
+    MQTT_SUBSCRIPTIONS = [(topic, 0) for topic in topic2index.keys()]
 
-if (
-    "user" in CONFIG["mqtt"]
-    and CONFIG["mqtt"]["user"] != ""
-    and "password" in CONFIG["mqtt"]
-    and CONFIG["mqtt"]["password"] != ""
-):
-    log.debug("Set username ({}) and password for MQTT connection".format(CONFIG["mqtt"]["user"]))
+if CONFIG["mqtt"].get("user") and CONFIG["mqtt"].get("password"):
+    log.debug("Set username (%s) and password for MQTT connection", CONFIG["mqtt"]["user"])
     client.username_pw_set(CONFIG["mqtt"]["user"], password=CONFIG["mqtt"]["password"])
 
 if CONFIG["mqtt"]["tls"]:
@@ -245,27 +666,52 @@ if CONFIG["mqtt"]["tls"]:
     else:
         client.tls_insecure_set(True)
 
-# initial creation of elasticsearch index
-for key, value in topic2index.items():
-    if CONFIG["removeIndex"]:
+if CONFIG["removeIndex"]:
+    for value in topic2index.values():
         removeElasticsearchIndex(value["elasticIndex"], exitAfterRemoval=True)
-    createElasticsearchIndex(value["elasticIndex"], value["elasticBody"])
+
+# initial creation of elasticsearch index, once per resolved index name and in parallel
+initialIndices = {}
+for index, body, hasPlaceholder in TOPIC_ROUTE.values():
+    initialIndices.setdefault(prepareElasticsearchIndex(index) if hasPlaceholder else index, body)
+with ThreadPoolExecutor(max_workers=16) as executor:
+    list(executor.map(lambda item: createElasticsearchIndex(*item, skipPrepare=True), initialIndices.items()))
+
+# start sending buffered documents in the background
+threading.Thread(target=bulkFlushWorker, daemon=True).start()
+atexit.register(flushBulkBuffer)
+
+# start processing received MQTT messages in the background
+log.debug("Starting %s worker threads", CONFIG["workers"])
+workers = [threading.Thread(target=messageWorker, daemon=True) for _ in range(CONFIG["workers"])]
+for worker in workers:
+    worker.start()
 
 # register MQTT callback functions
 client.on_connect = on_connect
+client.on_disconnect = on_disconnect
 client.on_message = on_message
 
 # connect to MQTT server
-log.debug("Connecting to MQTT server {}:{}".format(CONFIG["mqtt"]["server"], CONFIG["mqtt"]["port"]))
+log.debug("Connecting to MQTT server %s:%s", CONFIG["mqtt"]["server"], CONFIG["mqtt"]["port"])
 client.connect(CONFIG["mqtt"]["server"], CONFIG["mqtt"]["port"], 60)
 
-# Blocking call that processes network traffic, dispatches callbacks and
-# handles reconnecting.
-# Other loop*() functions are available that give a threaded interface and a
-# manual interface.
-client.loop_forever()
+# Process network traffic, dispatch callbacks and handle reconnecting in a
+# background thread, until we get stopped.
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+client.loop_start()
+STOP_EVENT.wait()
 
 client.disconnect()
+client.loop_stop()
+
+# let the workers finish the messages that are still queued
+for _ in workers:
+    MESSAGE_QUEUE.put(None)
+for worker in workers:
+    worker.join()
+flushBulkBuffer()
 
-log.info("MQTT to Eleasticsearch processor v{} stopped".format(VERSION))
-sys.exit()
+log.info("MQTT to Eleasticsearch processor v%s stopped", VERSION)
+sys.exit(EXIT_CODE)